@@ -4,17 +4,20 @@
 #
 # This code is part of the Fatiando a Terra project (https://www.fatiando.org)
 #
+import os
 import pickle
 
 import h5py
+import hdf5plugin
 import numba
 import numpy as np
 from matplotlib import animation
 from matplotlib import pyplot as plt
+from matplotlib.colors import Colormap
 from numpy import sqrt
 
-from ._base import BaseSimulation, anim_to_html
-from ._utils import apply_damping
+from ._base import BaseSimulation, anim_to_html, cached_video
+from ._utils import apply_damping, write_panels
 
 
 class Acoustic(BaseSimulation):
@@ -52,6 +55,8 @@ class Acoustic(BaseSimulation):
         * panels object : 2D panels object at index
 
         """
+        if isinstance(index, (int, np.integer)):
+            return self._read_frame(index)
         with self._get_cache() as f:
             data = f["panels"][index]
         return data
@@ -91,25 +96,44 @@ class Acoustic(BaseSimulation):
         sim.set_verbose(verbose)
         return sim
 
-    def _init_cache(self, npanels, chunks=None, compression="lzf", shuffle=True):
+    def _init_cache(
+        self,
+        npanels,
+        chunks=None,
+        compression="auto",
+        shuffle=False,
+    ):
         """
         Init the hdf5 cache file with this simulation parameters
 
         * npanels: int
             number of 2D panels needed for this simulation run
         *  chunks : HDF5 data set option
-            (Tuple) Chunk shape, or True to enable auto-chunking.
+            (Tuple) Chunk shape, or True to enable auto-chunking. If None,
+            will use whole panels for several time steps per chunk.
         * compression: HDF5 data set option
-            (String or int) Compression strategy.  Legal values are 'gzip',
-            'szip', 'lzf'.  If an integer in range(10), this indicates gzip
-            compression level. Otherwise, an integer indicates the number of a
-            dynamically loaded compression filter.
+            (String, int, or hdf5plugin filter) Compression strategy.  Legal
+            values are 'gzip', 'szip', 'lzf'.  If an integer in range(10),
+            this indicates gzip compression level. Otherwise, an integer
+            indicates the number of a dynamically loaded compression filter.
+            If 'auto', will use Blosc with LZ4 and bit shuffling for panels of
+            64 kB or more and no compression for smaller panels (compressing
+            them costs more time than writing them). Blosc uses a single
+            thread unless the BLOSC_NTHREADS environment variable is set.
         * shuffle: (bool) HDF5 data set option
-            (T/F) Enable shuffle filter.
+            (T/F) Enable shuffle filter. Not needed with the default Blosc
+            compression, which shuffles the data itself.
         """
         nz, nx = self.shape
         if chunks is None:
-            chunks = (1, nz // 10, nx // 10)
+            chunks = self._pick_chunks(self.shape, np.float32)
+        if compression == "auto":
+            if nz * nx * np.dtype(np.float32).itemsize < 64 * 1024:
+                compression = None
+            else:
+                compression = hdf5plugin.Blosc(
+                    cname="lz4", clevel=3, shuffle=hdf5plugin.Blosc.BITSHUFFLE
+                )
         with self._get_cache(mode="w") as f:  # create HDF5 data sets
             nz, nx = self.shape
             dset = f.create_dataset(
@@ -145,27 +169,25 @@ class Acoustic(BaseSimulation):
             cache = f["panels"]
             cache.resize(self.simsize + npanels, axis=0)
 
-    def _cache_panels(self, u, tp1, iteration, simul_size):
+    def _cache_panels(self, panels, iteration, simul_size):
         """
-        Save the last calculated panels and information about it
+        Save a batch of calculated panels and information about it
         in the hdf5 cache file
 
         Parameters:
 
-        * panels : tuple or variable
-            tuple or variable containing all 2D panels needed for
-            this simulation
-        * tp1 : int
-            panel time index
+        * panels : 3D array
+            the last ``panels.shape[0]`` panels calculated in this
+            simulation, in time order
         * iteration:
-            iteration number
+            iteration number of the last panel in the batch
         * simul_size:
             number of iterations that has been run
         """
-        # Save the panel to disk
+        # Save the panels to disk in a single write
         with self._get_cache(mode="a") as f:
             cache = f["panels"]
-            cache[simul_size - 1] = u[tp1]
+            write_panels(cache, panels, simul_size - panels.shape[0])
             cache.attrs["simsize"] = simul_size
             # I need to update the attribute with this iteration number
             # so that simulation runs properly after reloaded from file
@@ -190,7 +212,9 @@ class Acoustic(BaseSimulation):
         else:
             with self._get_cache() as f:
                 cache = f["panels"]
-                u = cache[self.simsize - 2 : self.simsize][::-1]
+                u = np.ascontiguousarray(
+                    cache[self.simsize - 2 : self.simsize][::-1], dtype=np.float32
+                )
         return u
 
     def add_point_source(self, position, wavelet):
@@ -208,16 +232,19 @@ class Acoustic(BaseSimulation):
         """
         self.sources.append([position, wavelet])
 
+    def _prepare_run(self):
+        # The tiles only depend on the simulation parameters so there is no
+        # need to build them every time step
+        nz, nx = self.shape
+        self._tiles = np.array(list(self._tile_iterator(3, nz - 3, 3, nx - 3)))
+
     def _timestep(self, u, tm1, t, tp1, iteration):
         nz, nx = self.shape
-        timestep_esg(
+        timestep_esg_tiles(
             u[tp1],
             u[t],
             u[tm1],
-            3,
-            nx - 3,
-            3,
-            nz - 3,
+            self._tiles,
             self.dt,
             self.dx,
             self.dz,
@@ -229,14 +256,13 @@ class Acoustic(BaseSimulation):
             u[tp1], u[t], nx, nz, self.dt, self.dx, self.dz, self.velocity, self.density
         )
         apply_damping(u[tp1], nx, nz, self.padding, self.taper)
-        for pos, src in self.sources:
+        for (pos, _), values in zip(self.sources, self._source_values):
             i, j = pos
             scale = -self.density[i, j] * (self.velocity[i, j] * self.dt) ** 2
-            u[tp1, i, j] += scale * src(iteration * self.dt)
+            u[tp1, i, j] += scale * values[iteration]
 
     def _plot_snapshot(self, frame, **kwargs):
-        with h5py.File(self.cachefile) as f:
-            data = f["panels"][frame]
+        data = self[frame]
         scale = kwargs.pop("cutoff", np.abs(data).max())
         nz, nx = self.shape
         dx, dz = nx * self.dx, nz * self.dz
@@ -274,6 +300,29 @@ class Acoustic(BaseSimulation):
         * embed:
 
         """
+        # Reuse the video from an earlier call if nothing has changed since.
+        # Can't tell what else is on a user given Axes so only do this for
+        # figures created here.
+        key = None
+        if embed and ax is None:
+            key = (
+                os.path.abspath(self.cachefile),
+                os.path.getmtime(self.cachefile),
+                self.simsize,
+                every,
+                cutoff,
+                repr(cmap.name if isinstance(cmap, Colormap) else cmap),
+                repr(sorted(kwargs.items())),
+            )
+            # Objects without a repr of their own (e.g., functions) are only
+            # identified by their memory address, which a different object
+            # can get later on. Can't tell if those have changed.
+            if any(" at 0x" in part for part in key[-2:]):
+                key = None
+        if key is not None:
+            video = cached_video(key, fps=fps, dpi=dpi)
+            if video is not None:
+                return video
         if ax is None:
             plt.figure(facecolor="white")
             ax = plt.subplot(111)
@@ -308,7 +357,7 @@ class Acoustic(BaseSimulation):
 
         anim = animation.FuncAnimation(fig, plot, frames=frames, **kwargs)
         if embed:
-            return anim_to_html(anim, fps=fps, dpi=dpi)
+            return anim_to_html(anim, fps=fps, dpi=dpi, key=key)
         else:
             plt.show()
             return anim
@@ -321,7 +370,24 @@ class Acoustic(BaseSimulation):
         return 0.6 * 0.606 * spacing / self.velocity.max()
 
 
-@numba.jit(nopython=True)
+# Release the GIL so that the cache writer thread can run meanwhile
+@numba.jit(nopython=True, parallel=True, nogil=True, cache=True)
+def timestep_esg_tiles(u_tp1, u_t, u_tm1, tiles, dt, dx, dz, vel, dens):
+    """
+    Run :func:`timestep_esg` on each tile of the grid in parallel.
+
+    Each row of *tiles* has the (z1, z2, x1, x2) limits of a tile. Tiles are
+    spread over the Numba threads and each one is updated in a single
+    thread so that it stays in that core's cache.
+    """
+    for k in numba.prange(tiles.shape[0]):
+        z1, z2, x1, x2 = tiles[k, 0], tiles[k, 1], tiles[k, 2], tiles[k, 3]
+        timestep_esg(u_tp1, u_t, u_tm1, x1, x2, z1, z2, dt, dx, dz, vel, dens)
+
+
+# Inline into timestep_esg_tiles so that the stencil is optimized together with
+# the parallel loop over the tiles
+@numba.jit(nopython=True, inline="always")
 def timestep_esg(  # noqa: CFQ002
     u_tp1, u_t, u_tm1, x1, x2, z1, z2, dt, dx, dz, vel, dens
 ):
@@ -329,12 +395,18 @@ def timestep_esg(  # noqa: CFQ002
     Perform a single time step in the Finite Difference solution for elastic
     SH waves using the Equivalent Staggered Grid method.
     """
+    # Compute the coefficients outside of the loop so that the divisions
+    # aren't repeated for every grid point
     dt2 = dt**2
     dx2 = dx**2
     dz2 = dz**2
+    cx1 = 1.125 / dx2
+    cx2 = 1 / (24 * dx2)
+    cz1 = 1.125 / dz2
+    cz2 = 1 / (24 * dz2)
     for i in range(z1, z2):
         for j in range(x1, x2):
-            zderiv = (1.125 / dz2) * (
+            zderiv = cz1 * (
                 0.5
                 * (1 / dens[i + 1, j] + 1 / dens[i, j])
                 * (
@@ -347,7 +419,7 @@ def timestep_esg(  # noqa: CFQ002
                     1.125 * (u_t[i, j] - u_t[i - 1, j])
                     - (u_t[i + 1, j] - u_t[i - 2, j]) / 24.0
                 )
-            ) - (1 / (24 * dz2)) * (
+            ) - cz2 * (
                 0.5
                 * (1 / dens[i + 2, j] + 1 / dens[i + 1, j])
                 * (
@@ -361,7 +433,7 @@ def timestep_esg(  # noqa: CFQ002
                     - (u_t[i, j] - u_t[i - 3, j]) / 24.0
                 )
             )
-            xderiv = (1.125 / dx2) * (
+            xderiv = cx1 * (
                 0.5
                 * (1 / dens[i, j + 1] + 1 / dens[i, j])
                 * (
@@ -374,7 +446,7 @@ def timestep_esg(  # noqa: CFQ002
                     1.125 * (u_t[i, j] - u_t[i, j - 1])
                     - (u_t[i, j + 1] - u_t[i, j - 2]) / 24.0
                 )
-            ) - (1.0 / (24.0 * dx2)) * (
+            ) - cx2 * (
                 0.5
                 * (1 / dens[i, j + 2] + 1 / dens[i, j + 1])
                 * (
@@ -395,7 +467,7 @@ def timestep_esg(  # noqa: CFQ002
             )
 
 
-@numba.jit(nopython=True)
+@numba.jit(nopython=True, nogil=True)
 def nonreflexive_bc(u_tp1, u_t, nx, nz, dt, dx, dz, mu, dens):
     """
     Apply nonreflexive boundary contitions to elastic SH waves.
@@ -9,27 +9,104 @@ Base class for 2D finite-difference simulations
 """
 
 import abc
+import collections
+import functools
 import os
+import queue
+import subprocess
 import tempfile
+import threading
+import time
 from tempfile import NamedTemporaryFile
 import base64
 
 import rich.progress
 import h5py
+import imageio_ffmpeg
 import numpy as np
 from IPython.core.pylabtools import print_figure
 from IPython.display import Video, Image
 from ipywidgets import widgets
 from matplotlib import pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 
+def progressbar(iterable, total=None, description="Simulating", update_interval=0.1):
+    """
+    Wrap an iterable in a rich progress bar that is cheap to update.
+
+    The clock is only checked every few iterations, with the number of
+    iterations between checks adapted to the measured speed of the loop so
+    that the bar is updated about once every *update_interval* seconds.
+    Between checks, the bar costs nothing but a loop counter. Rich redraws
+    the bar from its own refresh thread at the same rate.
+
+    Parameters:
+
+    * iterable : iterable
+        The iterable to loop over.
+    * total : int or None
+        The number of items in the iterable. If None, will use
+        ``len(iterable)`` if available or show a bar without a known end.
+    * description : str
+        Text shown to the left of the bar.
+    * update_interval : float
+        Approximate time (in seconds) between updates of the bar. Must be
+        positive.
+
+    Yields:
 
-def anim_to_html(anim, fps=6, dpi=30):
+    * item
+        The items of the iterable.
+
+    """
+    if update_interval <= 0:
+        raise ValueError(
+            "update_interval must be positive, got {}.".format(update_interval)
+        )
+    if total is None and hasattr(iterable, "__len__"):
+        total = len(iterable)
+    progress = rich.progress.Progress(
+        *rich.progress.Progress.get_default_columns(),
+        refresh_per_second=1 / update_interval,
+    )
+    with progress:
+        task = progress.add_task(description, total=total)
+        count = 0
+        next_check = 1
+        last_count, last_time = 0, time.perf_counter()
+        for count, item in enumerate(iterable, start=1):
+            yield item
+            if count == next_check:
+                now = time.perf_counter()
+                rate = (count - last_count) / max(now - last_time, 1e-9)
+                # Grow the interval gradually in case the loop slows down
+                step = min(int(rate * update_interval), 2 * (count - last_count))
+                next_check = count + max(1, step)
+                last_count, last_time = count, now
+                progress.update(task, completed=count)
+        progress.update(task, completed=count, total=count if total is None else total)
+
+
+# Base64 encoded videos of the most recent animations converted by
+# anim_to_html, indexed by the key given to it
+_VIDEO_CACHE = collections.OrderedDict()
+_VIDEO_CACHE_SIZE = 8
+
+
+def anim_to_html(anim, fps=6, dpi=30, key=None):
     """
     Convert a matplotlib animation object to a video embedded in an HTML
     <video> tag.
 
-    Uses avconv (default) or ffmpeg.
+    Draws each frame on an Agg canvas and pipes the raw RGBA pixels to
+    ffmpeg, which encodes them with libx264. The ffmpeg binary is the one
+    provided by the imageio-ffmpeg package.
+
+    If *key* is given, the encoded video is kept in a small cache and reused
+    in later calls with the same key, fps, and dpi (see
+    :func:`cached_video`). The key must identify everything that goes into
+    drawing the frames.
 
     Returns an IPython.display.HTML object for embedding in the notebook.
 
@@ -37,12 +114,97 @@ def anim_to_html(anim, fps=6, dpi=30):
     <http://yt-project.org/doc/cookbook/embedded_webm_animation.html>`__.
     """
     plt.close(anim._fig)
+    if key is not None:
+        video = cached_video(key, fps, dpi)
+        if video is not None:
+            return video
+    data = _encode_video(anim, fps, dpi)
+    if key is not None:
+        _VIDEO_CACHE[(key, fps, dpi)] = data
+        if len(_VIDEO_CACHE) > _VIDEO_CACHE_SIZE:
+            _VIDEO_CACHE.popitem(last=False)
+    return _embed_video(data)
+
+
+def cached_video(key, fps=6, dpi=30):
+    """
+    Get the video of an animation already converted by :func:`anim_to_html`.
+
+    Returns None if there is no video for this key, fps, and dpi in the
+    cache.
+    """
+    key = (key, fps, dpi)
+    if key not in _VIDEO_CACHE:
+        return None
+    _VIDEO_CACHE.move_to_end(key)
+    return _embed_video(_VIDEO_CACHE[key])
+
+
+def _encode_video(anim, fps, dpi):
+    """
+    Encode a matplotlib animation as an mp4 video in a base64 string.
+    """
+    fig = anim._fig
+    fig.set_dpi(dpi)
+    # Render off screen with Agg regardless of the backend in use
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    width, height = canvas.get_width_height(physical=True)
     with NamedTemporaryFile(suffix=".mp4") as f:
-        anim.save(f.name, fps=fps, dpi=dpi, writer="ffmpeg", extra_args=["-vcodec", "libx264"])
-        with open(f.name, "rb") as f:
-            video = f.read()
+        command = [
+            imageio_ffmpeg.get_ffmpeg_exe(),
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            "rgba",
+            "-s",
+            f"{width}x{height}",
+            "-r",
+            str(fps),
+            "-i",
+            "-",
+            # libx264 needs the frame dimensions to be even
+            "-vf",
+            "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+            "-vcodec",
+            "libx264",
+            "-pix_fmt",
+            "yuv420p",
+            "-crf",
+            "25",
+            f.name,
+        ]
+        # Start ffmpeg in its own session so that a KeyboardInterrupt in the
+        # notebook doesn't kill it mid-write. Unlike the preexec_fn that
+        # imageio-ffmpeg uses for this, it runs no Python code in the forked
+        # child. That hangs the interpreter at exit if Numba has been using
+        # the TBB threading layer.
+        with subprocess.Popen(
+            command, stdin=subprocess.PIPE, bufsize=1 << 20, start_new_session=True
+        ) as ffmpeg:
+            anim._init_draw()
+            for frame in anim.new_saved_frame_seq():
+                anim._draw_frame(frame)
+                canvas.draw()
+                ffmpeg.stdin.write(canvas.buffer_rgba())
+        if ffmpeg.returncode != 0:
+            raise subprocess.CalledProcessError(ffmpeg.returncode, command)
+        # Read the whole video in one go instead of in default sized blocks
+        size = os.stat(f.name).st_size
+        with open(f.name, "rb", buffering=1 << 20) as f:
+            video = f.read(size)
+    return base64.b64encode(video).decode()
+
+
+def _embed_video(data):
+    """
+    Create an embedded IPython video from a base64 encoded mp4.
+    """
     return Video(
-        data=base64.b64encode(video).decode(),
+        data=data,
         embed=True,
         mimetype="video/mp4",
         width=800,
@@ -50,6 +212,30 @@ def anim_to_html(anim, fps=6, dpi=30):
     )
 
 
+# The file modification time is part of the key of these caches so that
+# files that were written to since the last read are read again.
+@functools.lru_cache(maxsize=16)
+def _chunk_times(cachefile, mtime, dataset):
+    """
+    Get the number of time frames in each chunk of a cached dataset.
+    """
+    with h5py.File(cachefile, "r") as f:
+        chunks = f[dataset].chunks
+    if chunks is None:
+        return 1
+    return chunks[0]
+
+
+@functools.lru_cache(maxsize=4)
+def _read_chunk(cachefile, mtime, dataset, index):
+    """
+    Read all time frames in a time chunk of a cached dataset.
+    """
+    ntimes = _chunk_times(cachefile, mtime, dataset)
+    with h5py.File(cachefile, "r") as f:
+        return f[dataset][index * ntimes : (index + 1) * ntimes]
+
+
 class BaseSimulation(abc.ABC):
     """
     Base class for 2D simulations.
@@ -73,9 +259,15 @@ class BaseSimulation(abc.ABC):
         The hdf5 cachefile file path where the simulation is stored
     * shape: tuple
         2D panel numpy.shape without padding
+    * tile_shape: tuple
+        (z, x) size of the blocks used by ``_tile_iterator``. The default
+        keeps a tile of a float32 panel at 64 kB so that the panels involved
+        in a time step fit in the L2 cache.
 
     """
 
+    tile_shape = (64, 256)
+
     def __init__(
         self, cachefile, spacing, shape, dt=None, padding=50, taper=0.007, verbose=True
     ):
@@ -98,6 +290,10 @@ class BaseSimulation(abc.ABC):
         self.padding = padding  # padding region size
         self.taper = taper
         self.dt = dt
+        # (simsize, image) of the last PNG made by _repr_png_
+        self._last_png = None
+        # Values of the source wavelets for each time step of the current run
+        self._source_values = []
 
     def _create_tmp_cache(self):
         """
@@ -129,15 +325,49 @@ class BaseSimulation(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def _init_cache(self, npanels, chunks=None, compression="lzf", shuffle=True):
+    def _init_cache(
+        self,
+        npanels,
+        chunks=None,
+        compression="auto",
+        shuffle=False,
+    ):
         pass
 
+    @staticmethod
+    def _pick_chunks(shape, dtype, target_bytes=512 * 1024):
+        """
+        Pick a time-major HDF5 chunk shape for caching 2D panels
+
+        Each chunk holds whole panels for several consecutive time steps,
+        matching the way panels are written (in time order) and read (one
+        time step at a time).
+
+        Parameters:
+
+        * shape: tuple
+            2D panel shape
+        * dtype: numpy dtype
+            data type of the panels
+        * target_bytes: int
+            approximate uncompressed size of a chunk in bytes
+
+        Returns:
+
+        * chunks: tuple
+            3D chunk shape (time, z, x)
+
+        """
+        panel_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        ntimes = max(1, target_bytes // panel_bytes)
+        return (ntimes, *shape)
+
     @abc.abstractmethod
     def _expand_cache(self, npanels):
         pass
 
     @abc.abstractmethod
-    def _cache_panels(self, npanels, tp1, iteration, simul_size):
+    def _cache_panels(self, panels, iteration, simul_size):
         pass
 
     def _get_cache(self, mode="r"):
@@ -155,7 +385,36 @@ class BaseSimulation(abc.ABC):
         * cache : h5py file object
 
         """
-        return h5py.File(self.cachefile, mode)
+        # Give the chunk cache room for a few time chunks so that partial
+        # writes don't need to read back and decompress the chunk from disk
+        return h5py.File(self.cachefile, mode, rdcc_nbytes=32 << 20, rdcc_nslots=521)
+
+    def _read_frame(self, frame, dataset="panels"):
+        """
+        Read a single time frame from a dataset in the cache file.
+
+        Reads go through a small cache of whole time chunks so that looking
+        at consecutive frames (e.g., moving the slider in ``explore`` or
+        making an animation) only decompresses each chunk once.
+
+        Parameters:
+
+        * frame : int
+            The time frame. Negative values count from the end.
+        * dataset : str
+            The name of the time-chunked dataset in the cache file.
+
+        Returns:
+
+        * data : array
+            The data for this frame
+
+        """
+        frame = range(self.simsize)[frame]
+        mtime = os.stat(self.cachefile).st_mtime_ns
+        ntimes = _chunk_times(self.cachefile, mtime, dataset)
+        chunk = _read_chunk(self.cachefile, mtime, dataset, frame // ntimes)
+        return chunk[frame % ntimes].copy()
 
     def __getitem__(self, index):
         """
@@ -237,7 +496,11 @@ class BaseSimulation(abc.ABC):
         """
         Display one time frame of this simulation
         """
-        return self.snapshot(-1, raw=True)
+        # Rendering the figure is slow and notebooks call this often, so
+        # reuse the last image if the simulation hasn't run since
+        if self._last_png is None or self._last_png[0] != self.simsize:
+            self._last_png = (self.simsize, self.snapshot(-1, raw=True))
+        return self._last_png[1]
 
     def explore(self, every=1, **kwargs):
         """
@@ -267,6 +530,39 @@ class BaseSimulation(abc.ABC):
     def _timestep(self, panels, tm1, t, tp1, iteration):
         pass
 
+    def _prepare_run(self):
+        """
+        Set up anything the time steps of a run need but don't change.
+
+        Called by ``run`` before the time stepping starts. Does nothing by
+        default.
+        """
+        pass
+
+    def _tile_iterator(self, z1, z2, x1, x2):
+        """
+        Split a region of the panels into tiles of at most ``tile_shape``.
+
+        Time step implementations can update the panels one tile at a time
+        so that the stencil reads the same cached rows for all points in a
+        tile instead of streaming whole rows of the grid for each point.
+
+        Parameters:
+
+        * z1, z2, x1, x2 : int
+            The index limits of the region (end exclusive)
+
+        Yields:
+
+        * z1, z2, x1, x2 : int
+            The index limits of each tile (end exclusive)
+
+        """
+        tz, tx = self.tile_shape
+        for tz1 in range(z1, z2, tz):
+            for tx1 in range(x1, x2, tx):
+                yield tz1, min(tz1 + tz, z2), tx1, min(tx1 + tx, x2)
+
     def run(self, iterations):
         """
         Run this simulation given the number of iterations.
@@ -280,6 +576,7 @@ class BaseSimulation(abc.ABC):
         nz, nx = self.shape
         dz, dx = self.dz, self.dx
         u = self._init_panels()  # panels must be created first
+        self._last_png = None
 
         # Initialize the cache on the first run
         if self.simsize == 0:
@@ -287,15 +584,90 @@ class BaseSimulation(abc.ABC):
         else:  # increase cache size by iterations
             self._expand_cache(iterations)
 
+        # Evaluate the source wavelets for all time steps of this run at once
+        # so that the time stepping only needs to look them up. Done for
+        # every run in case the sources have changed since the last one.
+        self._source_values = [
+            wavelet.precompute(self.dt, self.simsize + iterations)
+            for _, wavelet in self.sources
+        ]
+        self._prepare_run()
+
         iterator = range(iterations)
         if self.verbose:
-            iterator = rich.progress.track(iterator)
-
-        for iteration in iterator:
-            t, tm1 = iteration % 2, (iteration + 1) % 2
-            tp1 = tm1
-            self.it += 1
-            self._timestep(u, tm1, t, tp1, self.it)
-            self.simsize += 1
-            #  won't this make it slower than it should? I/O
-            self._cache_panels(u, tp1, self.it, self.simsize)
+            iterator = progressbar(iterator)
+
+        # Stage the new panels in memory and write them to the cache in
+        # batches the size of a time chunk. One large write is much cheaper
+        # than many single panel writes that each go through the HDF5 filter
+        # pipeline. Panels are always cached in single precision, which halves
+        # the data that has to be compressed and written compared to float64.
+        batch = self._pick_chunks(u.shape[1:], np.float32)[0]
+        staging = np.empty((batch,) + u.shape[1:], dtype=np.float32)
+        nstaged = 0
+        # A previous run may have ended in the middle of a chunk. Make the
+        # first batch only fill up that chunk so that all later batches cover
+        # whole chunks.
+        nflush = batch - self.simsize % batch
+
+        # Write the batches to the cache from a separate thread so that the
+        # time stepping doesn't stall on HDF5 I/O and compression. The queue
+        # is bounded to keep memory in check if the disk can't keep up.
+        writes = queue.Queue(maxsize=8)
+        errors = []
+        # The (it, simsize) of the last panel that made it into the cache
+        written = [self.it, self.simsize]
+
+        def writer():
+            while True:
+                item = writes.get()
+                if item is None:
+                    return
+                # Keep draining the queue after an error so that the time
+                # stepping loop never blocks on a full queue
+                if not errors:
+                    try:
+                        self._cache_panels(*item)
+                    except Exception as error:
+                        errors.append(error)
+                    else:
+                        written[:] = item[1:]
+
+        thread = threading.Thread(target=writer, daemon=True)
+        thread.start()
+        # Keep the loop state in local variables. Attribute lookups and the
+        # time index arithmetic add up for small grids with fast time steps.
+        timestep = self._timestep
+        it, simsize = self.it, self.simsize
+        t = 0
+        try:
+            for _ in iterator:
+                # The panel for t - 1 is overwritten by the one for t + 1
+                tm1 = tp1 = t ^ 1
+                it += 1
+                timestep(u, tm1, t, tp1, it)
+                simsize += 1
+                staging[nstaged] = u[tp1]
+                nstaged += 1
+                if nstaged == nflush:
+                    # The writer owns this buffer now so start a new one
+                    writes.put((staging[:nstaged], it, simsize))
+                    staging = np.empty_like(staging)
+                    nstaged = 0
+                    nflush = batch
+                if errors:
+                    break
+                t = tp1
+        finally:
+            # Stop the progress bar display if the loop ended early
+            if hasattr(iterator, "close"):
+                iterator.close()
+            if nstaged > 0 and not errors:
+                writes.put((staging[:nstaged], it, simsize))
+            writes.put(None)
+            thread.join()
+            # Only count the iterations that are in the cache. If a write
+            # failed, the next run resumes from the last panels written.
+            self.it, self.simsize = written
+        if errors:
+            raise errors[0]
@@ -8,7 +8,7 @@ import numba
 import numpy as np
 
 
-@numba.jit(nopython=True)
+@numba.jit(nopython=True, nogil=True)
 def apply_damping(array, nx, nz, pad, decay):
     """
     Apply a decay factor to the values of the array in the padding region.
@@ -140,3 +140,46 @@ def lame_mu(svel, dens):
     """
     mu = dens * svel**2
     return mu
+
+
+def write_panels(dset, panels, start):
+    """
+    Write consecutive 2D panels to a time-chunked HDF5 dataset.
+
+    If the dataset has no filters (e.g., no compression), panels that fill
+    whole chunks are written directly to the file as raw chunks, skipping
+    the HDF5 filter pipeline and chunk cache. The remaining panels, and
+    datasets with filters, go through a regular h5py write.
+
+    Parameters:
+
+    * dset : h5py.Dataset
+        3D dataset with chunks that span whole panels
+    * panels : 3D array
+        the consecutive panels to write
+    * start : int
+        index of the first panel in the dataset
+
+    """
+    end = start + panels.shape[0]
+    direct = (
+        dset.chunks is not None
+        and dset.chunks[1:] == dset.shape[1:]
+        and dset.id.get_create_plist().get_nfilters() == 0
+    )
+    if not direct:
+        dset[start:end] = panels
+        return
+    ntimes = dset.chunks[0]
+    # Range of panels that make up whole chunks
+    first = -(-start // ntimes) * ntimes
+    last = max(first, end // ntimes * ntimes)
+    if first > start:
+        dset[start : min(first, end)] = panels[: first - start]
+    if last < end:
+        dset[last:end] = panels[last - start :]
+    for offset in range(first, last, ntimes):
+        chunk = np.ascontiguousarray(
+            panels[offset - start : offset - start + ntimes], dtype=dset.dtype
+        )
+        dset.id.write_direct_chunk((offset, 0, 0), chunk)
@@ -7,6 +7,7 @@
 import abc
 import copy
 
+import numba
 import numpy as np
 
 
@@ -19,6 +20,25 @@ class BaseWavelet(abc.ABC):
     def __call__(self, time):
         pass
 
+    def precompute(self, dt, n):
+        """
+        Evaluate the wavelet for the first n time steps of size dt at once.
+
+        Parameters:
+
+        * dt : float
+            The time step
+        * n : int
+            The number of time steps
+
+        Returns:
+
+        * values : 1D array
+            The wavelet at times ``i*dt`` for i in ``range(n)``
+
+        """
+        return self(np.arange(n) * dt)
+
     def copy(self):
         return copy.deepcopy(self)
 
@@ -31,15 +51,9 @@ class GaussianWavelet(BaseWavelet):
         self.delay = delay
 
     def __call__(self, time):
-        sqrt_pi = np.sqrt(np.pi)
-        fc = self.f_cut / (3 * sqrt_pi)
-        # Standard delay to make the wavelet start at time zero and be causal
-        td = time - 2 * sqrt_pi / self.f_cut
-        # Apply the user defined delay on top
-        t = td - self.delay
-        scale = self.amp / (2 * np.pi * (np.pi * fc) ** 2)
-        res = scale * np.exp(-np.pi * (np.pi * fc * t) ** 2)
-        return res
+        if not np.isscalar(time):
+            time = np.asarray(time)
+        return _gaussian(time, self.amp, self.f_cut, self.delay)
 
 
 class RickerWavelet(BaseWavelet):
@@ -50,12 +64,38 @@ class RickerWavelet(BaseWavelet):
         self.delay = delay
 
     def __call__(self, time):
-        sqrt_pi = np.sqrt(np.pi)
-        fc = self.f_cut / (3 * sqrt_pi)
-        # Standard delay to make the wavelet start at time zero and be causal
-        td = time - 2 * sqrt_pi / self.f_cut
-        # Apply the user defined delay on top
-        t = td - self.delay
-        scale = self.amp * (2 * np.pi * (np.pi * fc * t) ** 2 - 1)
-        res = scale * np.exp(-np.pi * (np.pi * fc * t) ** 2)
-        return res
+        if not np.isscalar(time):
+            time = np.asarray(time)
+        return _ricker(time, self.amp, self.f_cut, self.delay)
+
+
+@numba.jit(nopython=True, fastmath=True, cache=True)
+def _gaussian(time, amp, f_cut, delay):
+    """
+    Evaluate a Gaussian wavelet at the given time (float or array).
+    """
+    sqrt_pi = np.sqrt(np.pi)
+    fc = f_cut / (3 * sqrt_pi)
+    # Standard delay to make the wavelet start at time zero and be causal
+    td = time - 2 * sqrt_pi / f_cut
+    # Apply the user defined delay on top
+    t = td - delay
+    scale = amp / (2 * np.pi * (np.pi * fc) ** 2)
+    res = scale * np.exp(-np.pi * (np.pi * fc * t) ** 2)
+    return res
+
+
+@numba.jit(nopython=True, fastmath=True, cache=True)
+def _ricker(time, amp, f_cut, delay):
+    """
+    Evaluate a Ricker wavelet at the given time (float or array).
+    """
+    sqrt_pi = np.sqrt(np.pi)
+    fc = f_cut / (3 * sqrt_pi)
+    # Standard delay to make the wavelet start at time zero and be causal
+    td = time - 2 * sqrt_pi / f_cut
+    # Apply the user defined delay on top
+    t = td - delay
+    scale = amp * (2 * np.pi * (np.pi * fc * t) ** 2 - 1)
+    res = scale * np.exp(-np.pi * (np.pi * fc * t) ** 2)
+    return res